@@ -3,23 +3,40 @@ import re
 import json
 import uuid
 import fcntl
+import shutil
 import mimetypes
 import base64
+import hashlib
+import html as html_lib
+import threading
+import time
 import requests
-from urllib.parse import urlparse, unquote
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse, unquote_to_bytes
 from datetime import datetime
+from flask.json.provider import DefaultJSONProvider
 from flask import (
     Flask, request, render_template, redirect, url_for,
-    flash, session, send_from_directory, jsonify, Response, stream_with_context
+    flash, session, send_from_directory, jsonify, Response, stream_with_context,
 )
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
 from werkzeug.utils import secure_filename
 import urllib.request
 import urllib.error
 import bleach
 from bleach.css_sanitizer import CSSSanitizer
+from bleach.html5lib_shim import Filter
 from .models import db, Section, Subsection, Article, Attachment, ArticleRevision, Chunk, Favorite
 from .utils import parse_users_file, current_user, login_required, admin_required
-from .rag import rebuild_article_chunks, rebuild_all_chunks
+from .rag import html_to_text, rebuild_article_chunks, rebuild_all_chunks
+
+try:
+    import orjson
+except ImportError:  # без orjson — стандартный json
+    orjson = None
 
 
 
@@ -53,6 +70,31 @@ def create_app():
 
     db.init_app(app)
 
+    # --- JSON: orjson (если установлен) для jsonify и потоковых экспортов ---
+    if orjson is not None:
+        class _OrjsonProvider(DefaultJSONProvider):
+            def dumps(self, obj, **kwargs):
+                # indent (debug) и прочие нестандартные опции — штатным json
+                if set(kwargs) - {"separators"}:
+                    return super().dumps(obj, **kwargs)
+                opts = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+                return orjson.dumps(obj, default=self.default, option=opts).decode("utf-8")
+
+            def loads(self, s, **kwargs):
+                return orjson.loads(s)
+
+        app.json = _OrjsonProvider(app)
+
+        def _json_bytes(obj) -> bytes:
+            return orjson.dumps(obj)
+
+        _json_loads = orjson.loads
+    else:
+        def _json_bytes(obj) -> bytes:
+            return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+        _json_loads = json.loads
+
     # --- Безопасная очистка HTML (разрешаем медиа) ---
     ALLOWED_TAGS = [
         "p", "br", "hr", "span", "div", "pre", "code",
@@ -103,17 +145,40 @@ def create_app():
         )
 
 
-    def sanitize_html(html: str) -> str:
-        return bleach.clean(
-            html or "",
-            tags=ALLOWED_TAGS,
-            attributes=ALLOWED_ATTRS,
-            protocols=ALLOWED_PROTOCOLS,
-            css_sanitizer=css_sanitizer,
-            strip=False,
-        )   
     # --- Локализация внешних картинок/медиа в /uploads ---
     _REMOTE_MAX_BYTES = int(os.environ.get("MAX_REMOTE_MEDIA_BYTES", 25 * 1024 * 1024))  # 25 МБ на единицу
+    _MEDIA_FETCH_WORKERS = int(os.environ.get("MEDIA_FETCH_WORKERS", 8))  # параллельных загрузок на статью
+    _STREAM_CHUNK_BYTES = 256 * 1024  # размер блока при потоковой записи файлов на диск
+
+    # префикс и шаблон ссылок на загруженные файлы — считаем один раз, а не на каждое сохранение
+    _upload_url = app.config["UPLOAD_URL"].rstrip("/")
+    _upload_prefix = _upload_url + "/"
+    # src/href только внутри открывающего тега медиа или ссылки: bleach экранирует "<" в тексте,
+    # так что "src=..." из <pre> или прозы сюда не попадёт; предыдущие атрибуты пропускаем
+    # целиком вместе со значениями, чтобы не зацепить "src=" внутри title="..."
+    _UPLOAD_SRC_HREF_RE = re.compile(
+        r"""<(?:img|video|audio|source|a)\b"""
+        r"""(?:\s+[^\s"'>/=]+(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'>]+))?)*?"""
+        rf"""\s+(?:src|href)\s*=\s*(["'])\s*{re.escape(_upload_url)}/([^"']+?)\s*\1""",
+        re.IGNORECASE,
+    )
+    _LOCALIZE_TAGS = frozenset(("img", "video", "audio", "source"))
+
+    # Общая HTTP-сессия: keep-alive и пул соединений, чтобы картинки с одного CDN
+    # не платили за новый TCP/TLS-хендшейк на каждый файл
+    _http = requests.Session()
+    # Базовые заголовки — некоторые CDN капризничают без User-Agent
+    _http.headers.update({
+        "User-Agent": "LertoWiki/1.0 (+https://lerto.local)",
+        "Accept": "*/*",
+    })
+    _http_adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+    )
+    _http.mount("http://", _http_adapter)
+    _http.mount("https://", _http_adapter)
 
     _EXT_BY_MIME = {
         "image/jpeg": ".jpg",
@@ -156,20 +221,79 @@ def create_app():
             f.write(data)
         return fname, url_for("uploaded_file", filename=fname)
 
-    def _download_to_uploads(url: str) -> tuple[str | None, str | None]:
+    def _save_upload(file, path: str):
+        """Пишет загруженный файл на диск крупными блоками (werkzeug по умолчанию копирует по 16 КБ)."""
+        with open(path, "wb") as dst:
+            shutil.copyfileobj(file.stream, dst, length=_STREAM_CHUNK_BYTES)
+
+    # содержимое загрузок из редактора хранится один раз: <хеш><ext> в скрытом каталоге,
+    # а каждая загрузка получает своё имя — жёсткую ссылку на него
+    _BLOB_DIR = os.path.join(app.config["UPLOAD_FOLDER"], ".blobs")
+    _BLOB_NAME_RE = re.compile(r"^([0-9a-f]{32})-[0-9a-f]{8}(\.[^.]*)?$")
+
+    def _blob_path(fname: str) -> str | None:
+        """Путь к общему блобу для имени загрузки <хеш>-<id><ext>; None — файл не из редактора."""
+        m = _BLOB_NAME_RE.match(fname)
+        if not m:
+            return None
+        return os.path.join(_BLOB_DIR, f"{m.group(1)}{m.group(2) or ''}")
+
+    def _save_upload_by_hash(file, ext: str) -> str:
         """
-        Качает внешний ресурс в /uploads. Возвращает (filename, url) или (None, None) при неудаче.
-        Ограничение по размеру — _REMOTE_MAX_BYTES.
+        Пишет загруженный файл во временный файл в /uploads, по пути считая blake2b, и
+        сохраняет его под собственным именем <хеш>-<id><ext>. Если такое содержимое уже
+        есть, новое имя — жёсткая ссылка на существующий блоб: данные на диске одни,
+        а удаление одной загрузки не трогает другие. Возвращает имя итогового файла.
         """
+        folder = app.config["UPLOAD_FOLDER"]
+        digest = hashlib.blake2b(digest_size=16)
+        tmp = os.path.join(folder, f".upload-{uuid.uuid4().hex}.part")
         try:
-            # Базовые заголовки — некоторые CDN капризничают без User-Agent
-            headers = {
-                "User-Agent": "LertoWiki/1.0 (+https://lerto.local)",
-                "Accept": "*/*",
-            }
-            with requests.get(url, headers=headers, stream=True, timeout=(7, 30)) as r:
+            with open(tmp, "xb") as dst:
+                while True:
+                    buf = file.stream.read(_STREAM_CHUNK_BYTES)
+                    if not buf:
+                        break
+                    digest.update(buf)
+                    dst.write(buf)
+            fname = secure_filename(f"{digest.hexdigest()}-{uuid.uuid4().hex[:8]}{ext}")
+            final = os.path.join(folder, fname)
+            blob = _blob_path(fname)
+            try:
+                os.link(blob, final)  # такое содержимое уже есть — переиспользуем
+                os.unlink(tmp)
+            except OSError:
+                os.replace(tmp, final)
+                # публикуем блоб для следующих загрузок; не вышло — просто без дедупликации
+                try:
+                    os.makedirs(_BLOB_DIR, exist_ok=True)
+                    os.link(final, blob)
+                except OSError:
+                    pass
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        return fname
+
+    def _download_to_uploads(url: str) -> str | None:
+        """
+        Качает внешний ресурс в /uploads. Возвращает имя файла или None при неудаче.
+        Ограничение по размеру — _REMOTE_MAX_BYTES. Контекст запроса не нужен:
+        функция выполняется в потоках пула, URL строит вызывающий.
+        """
+        try:
+            with _http.get(url, stream=True, timeout=(7, 30)) as r:
                 r.raise_for_status()
 
+                # сервер сам сообщил, что файл больше лимита — не качаем вовсе
+                # (счётчик ниже остаётся на случай chunked-ответов без длины)
+                clen = (r.headers.get("Content-Length") or "").strip()
+                if clen.isdigit() and int(clen) > _REMOTE_MAX_BYTES:
+                    return None
+
                 ctype = (r.headers.get("Content-Type") or "").split(";")[0].strip().lower()
                 # если сервер не прислал тип — попробуем угадать по расширению
                 if not _is_allowed_media_mime(ctype):
@@ -177,7 +301,7 @@ def create_app():
                     if guessed:
                         ctype = guessed
                 if not _is_allowed_media_mime(ctype):
-                    return None, None
+                    return None
 
                 # Имя файла — из Content-Disposition либо из URL-пути
                 disp = r.headers.get("Content-Disposition") or ""
@@ -190,22 +314,30 @@ def create_app():
                     except Exception:
                         fallback_name = ""
 
-                # Стримим в память с ограничением
-                chunks = []
-                total = 0
-                for chunk in r.iter_content(chunk_size=65536):
-                    if not chunk:
-                        break
-                    total += len(chunk)
-                    if total > _REMOTE_MAX_BYTES:
-                        return None, None
-                    chunks.append(chunk)
-                data = b"".join(chunks)
-
-                fname, local_url = _save_bytes_to_uploads(data, ctype, fallback_name=fallback_name)
-                return fname, local_url
+                # Стримим сразу на диск с ограничением (без буфера на весь файл в памяти)
+                ext = _choose_ext(ctype, fallback_name)
+                fname = secure_filename(f"{uuid.uuid4().hex}{ext}")
+                path = os.path.join(app.config["UPLOAD_FOLDER"], fname)
+                try:
+                    total = 0
+                    with open(path, "wb") as f:
+                        for chunk in r.iter_content(chunk_size=_STREAM_CHUNK_BYTES):
+                            if not chunk:
+                                break
+                            total += len(chunk)
+                            if total > _REMOTE_MAX_BYTES:
+                                raise ValueError("remote media exceeds size limit")
+                            f.write(chunk)
+                except Exception:
+                    # недокачанный или слишком большой файл на диске не оставляем
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                    raise
+                return fname
         except Exception:
-            return None, None
+            return None
 
     def _data_uri_to_upload(uri: str) -> tuple[str | None, str | None]:
         """
@@ -228,10 +360,13 @@ def create_app():
                 return None, None
 
             if is_base64:
+                # заведомо слишком большие не декодируем (4 символа base64 -> 3 байта)
+                if len(data_part) // 4 * 3 > _REMOTE_MAX_BYTES:
+                    return None, None
                 raw = base64.b64decode(data_part, validate=False)
             else:
-                # не base64 — обычно urlencoded
-                raw = unquote(data_part).encode("utf-8")
+                # не base64 — обычно urlencoded; сразу в байты, без промежуточной строки
+                raw = unquote_to_bytes(data_part)
 
             if len(raw) > _REMOTE_MAX_BYTES:
                 return None, None
@@ -241,86 +376,155 @@ def create_app():
         except Exception:
             return None, None
 
-    def localize_external_media(html: str) -> str:
+    def _localize_urls(urls) -> dict:
         """
-        Находит в HTML теги <img>/<video>/<audio>/<source> с src:
-          - data:...         -> сохраняет в /uploads, подменяет src
-          - http/https:...   -> скачивает на сервер, подменяет src
-        Уже локальные (/uploads/...) — не трогаем.
-        Если BeautifulSoup недоступен — возвращаем исходный HTML.
+        Переносит внешние медиа в /uploads, возвращает {исходный url: локальный url}.
+          - data:...         -> декодируем здесь же (дёшево)
+          - http/https:...   -> качаем параллельно (ожидание сети), одинаковые — один раз
+        Неудачные URL в результат не попадают.
+        """
+        result = {}
+        remote_urls = []
+        for url in dict.fromkeys(urls):
+            if url.startswith("data:"):
+                _fname, local_url = _data_uri_to_upload(url)
+                if local_url:
+                    result[url] = local_url
+            else:
+                remote_urls.append(url)
+
+        if remote_urls:
+            # в потоках пула только сеть и диск; контекст запроса туда не передаём
+            # (его закрытие в потоке закрыло бы загруженные файлы формы), url_for — здесь
+            with ThreadPoolExecutor(max_workers=min(_MEDIA_FETCH_WORKERS, len(remote_urls))) as pool:
+                futures = {url: pool.submit(_download_to_uploads, url) for url in remote_urls}
+            for url, fut in futures.items():
+                fname = fut.result()
+                if fname:
+                    result[url] = url_for("uploaded_file", filename=fname)
+        return result
+
+    class _MediaLocalizer(Filter):
+        """
+        html5lib-фильтр для bleach: в том же проходе, что и очистка, находит
+        <img>/<video>/<audio>/<source> с внешним src (data:/http/https) и подменяет
+        его на локальную копию в /uploads. Уже локальные и прочие схемы не трогаем;
+        при неудаче загрузки остаётся исходный URL.
         """
-        try:
-            from bs4 import BeautifulSoup
-        except Exception:
-            return html or ""
-
-        if not html:
-            return ""
-
-        soup = BeautifulSoup(html, "html.parser")
-        upload_url = app.config["UPLOAD_URL"].rstrip("/")
-
-        def _process_tag(tag, attr="src"):
-            val = tag.get(attr)
-            if not val:
-                return
-            v = val.strip()
 
-            # Уже локальный?
-            if v.startswith(upload_url + "/") or v.startswith(url_for("uploaded_file", filename="").rstrip("/")):
-                return
+        def __iter__(self):
+            # буферизуем поток токенов, чтобы скачать все медиа статьи разом
+            tokens = list(super().__iter__())
+            local_prefix = url_for("uploaded_file", filename="").rstrip("/")
+
+            jobs = []  # (token, url)
+            media_depth = 0  # <source> интересуют только внутри video/audio
+            for token in tokens:
+                ttype = token["type"]
+                name = token.get("name")
+                if ttype == "EndTag" and name in ("video", "audio"):
+                    media_depth = max(media_depth - 1, 0)
+                    continue
+                if ttype not in ("StartTag", "EmptyTag"):
+                    continue
+                if name in ("video", "audio") and ttype == "StartTag":
+                    media_depth += 1
+                if name not in _LOCALIZE_TAGS:
+                    continue
+                if name == "source" and not media_depth:
+                    continue
 
-            # data:...
-            if v.startswith("data:"):
-                _fname, local_url = _data_uri_to_upload(v)
-                if local_url:
-                    tag[attr] = local_url
-                return
+                val = (token["data"].get((None, "src")) or "").strip()
+                if not val:
+                    continue
+                # Уже локальный?
+                if val.startswith(_upload_prefix) or val.startswith(local_prefix):
+                    continue
+                if val.startswith(("data:", "http://", "https://")):
+                    jobs.append((token, val))
+                # Остальные протоколы/форматы не трогаем (mailto:, blob:, file:, и т.п.)
+
+            if jobs:
+                localized = _localize_urls(url for _token, url in jobs)
+                for token, url in jobs:
+                    if url in localized:
+                        token["data"][(None, "src")] = localized[url]
+
+            yield from tokens
+
+    # --- Очистка HTML статьи (одним проходом с локализацией медиа) ---
+    # bleach.Cleaner дорог в создании (html5lib-парсер, фильтры), но не потокобезопасен —
+    # держим по одному экземпляру на поток и переиспользуем между запросами
+    _cleaner_local = threading.local()
+
+    def _get_cleaner() -> bleach.Cleaner:
+        cleaner = getattr(_cleaner_local, "cleaner", None)
+        if cleaner is None:
+            cleaner = bleach.Cleaner(
+                tags=ALLOWED_TAGS,
+                attributes=ALLOWED_ATTRS,
+                protocols=ALLOWED_PROTOCOLS,
+                css_sanitizer=css_sanitizer,
+                strip=False,
+                filters=[_MediaLocalizer],
+            )
+            _cleaner_local.cleaner = cleaner
+        return cleaner
 
-            # http/https:...
-            if v.startswith("http://") or v.startswith("https://"):
-                _fname, local_url = _download_to_uploads(v)
-                if local_url:
-                    tag[attr] = local_url
-                return
-
-            # Остальные протоколы/форматы не трогаем (mailto:, blob:, file:, и т.п.)
-
-        # img/src
-        for img in soup.find_all("img"):
-            _process_tag(img, "src")
-            # при наличии srcset возьмём первый URL и тоже локализуем (упрощённо)
-            srcset = img.get("srcset")
-            if srcset and isinstance(srcset, str):
-                first = srcset.split(",")[0].strip()
-                url_only = first.split(" ")[0]
-                if url_only.startswith(("http://", "https://", "data:")):
-                    _fname, local_url = (None, None)
-                    if url_only.startswith("data:"):
-                        _fname, local_url = _data_uri_to_upload(url_only)
-                    else:
-                        _fname, local_url = _download_to_uploads(url_only)
-                    if local_url:
-                        img["src"] = local_url
-                        img.attrs.pop("srcset", None)  # убираем srcset, чтобы не было конфликтов
-
-        # video/audio/src
-        for media in soup.find_all(["video", "audio"]):
-            _process_tag(media, "src")
-            for source in media.find_all("source"):
-                _process_tag(source, "src")
-
-        return str(soup)
+    def sanitize_html(html: str) -> str:
+        """
+        Очищает HTML статьи и заодно переносит внешние медиа (data:/http/https) в /uploads.
+        Вызывать в контексте запроса — нужен url_for.
+        """
+        if not html or not html.strip():
+            return ""
+        return _get_cleaner().clean(html)
 
     # --- Создание схемы и "тихие миграции" под файлоком ---
+    # Версия схемы хранится в schema_meta; увеличивать при добавлении DDL в список ниже,
+    # иначе уже обновлённые БД новые миграции не увидят.
+    SCHEMA_VERSION = 8
+
+    _ARTICLE_FTS_DDL = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS article_fts"
+        " USING fts5(title, content, content='articles', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS articles_fts_ai AFTER INSERT ON articles BEGIN"
+        " INSERT INTO article_fts(rowid, title, content) VALUES (new.id, new.title, new.content);"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS articles_fts_ad AFTER DELETE ON articles BEGIN"
+        " INSERT INTO article_fts(article_fts, rowid, title, content)"
+        " VALUES ('delete', old.id, old.title, old.content);"
+        " END",
+        "CREATE TRIGGER IF NOT EXISTS articles_fts_au AFTER UPDATE OF title, content ON articles BEGIN"
+        " INSERT INTO article_fts(article_fts, rowid, title, content)"
+        " VALUES ('delete', old.id, old.title, old.content);"
+        " INSERT INTO article_fts(rowid, title, content) VALUES (new.id, new.title, new.content);"
+        " END",
+        # проиндексировать уже существующие статьи
+        "INSERT INTO article_fts(article_fts) VALUES ('rebuild')",
+    ]
+    _ARTICLE_FTS_DROP = [
+        "DROP TRIGGER IF EXISTS articles_fts_ai",
+        "DROP TRIGGER IF EXISTS articles_fts_ad",
+        "DROP TRIGGER IF EXISTS articles_fts_au",
+        "DROP TABLE IF EXISTS article_fts",
+    ]
+
     with app.app_context():
         lock_path = "/data/.db_init.lock"
         fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
         try:
             fcntl.flock(fd, fcntl.LOCK_EX)
             db.create_all()
-            from sqlalchemy import text
-            for ddl in [
+            db.session.execute(text(
+                "CREATE TABLE IF NOT EXISTS schema_meta (key VARCHAR(64) PRIMARY KEY, value TEXT)"
+            ))
+            stored = db.session.execute(
+                text("SELECT value FROM schema_meta WHERE key = 'version'")
+            ).scalar()
+            current_version = int(stored) if stored and str(stored).isdigit() else 0
+
+            migrations = [] if current_version >= SCHEMA_VERSION else [
                 'CREATE TABLE IF NOT EXISTS favorites ('
                 ' id INTEGER PRIMARY KEY,'
                 ' user_login VARCHAR(64) NOT NULL,'
@@ -334,10 +538,13 @@ def create_app():
                 'ALTER TABLE articles ADD COLUMN is_deleted BOOLEAN DEFAULT 0',
                 'ALTER TABLE articles ADD COLUMN deleted_at DATETIME',
                 'ALTER TABLE articles ADD COLUMN deleted_by_login VARCHAR(64)',
+                'ALTER TABLE articles ADD COLUMN content_text TEXT',
+                'ALTER TABLE articles ADD COLUMN content_sha VARCHAR(32)',
             
                 # --- ревизии статей ---
                 'ALTER TABLE article_revisions ADD COLUMN attachments_json TEXT',
                 'ALTER TABLE article_revisions ADD COLUMN created_at DATETIME',
+                'ALTER TABLE article_revisions ADD COLUMN content_zstd BLOB',
             
                 # --- разделы ---
                 'ALTER TABLE sections ADD COLUMN updated_at DATETIME',
@@ -352,36 +559,110 @@ def create_app():
                 'ALTER TABLE subsections ADD COLUMN is_deleted BOOLEAN DEFAULT 0',
                 'ALTER TABLE subsections ADD COLUMN deleted_at DATETIME',
                 'ALTER TABLE subsections ADD COLUMN deleted_by_login VARCHAR(64)',
-            ]:
+
+                # --- индексы под списки (is_deleted + сортировка) ---
+                'CREATE INDEX IF NOT EXISTS ix_articles_active_updated ON articles (is_deleted, updated_at DESC)',
+                'CREATE INDEX IF NOT EXISTS ix_subsections_active ON subsections (section_id, is_deleted, title)',
+
+                # --- индексы под корзину, каскады по FK и RAG ---
+                'CREATE INDEX IF NOT EXISTS ix_articles_deleted ON articles (is_deleted, deleted_at)',
+                'CREATE INDEX IF NOT EXISTS ix_articles_subsection_deleted ON articles (subsection_id, is_deleted)',
+                'CREATE INDEX IF NOT EXISTS ix_subsections_deleted ON subsections (is_deleted, deleted_at)',
+                'CREATE INDEX IF NOT EXISTS ix_sections_deleted ON sections (is_deleted, deleted_at)',
+                'CREATE INDEX IF NOT EXISTS ix_chunks_article_idx ON chunks (article_id, idx)',
+            ]
+            for ddl in migrations:
                 try:
                     db.session.execute(text(ddl))
                 except Exception:
                     pass
             db.session.commit()
+
+            # полнотекстовый индекс статей (SQLite FTS5): external-content таблица + триггеры
+            if migrations and db.engine.dialect.name == "sqlite":
+                try:
+                    for ddl in _ARTICLE_FTS_DDL:
+                        db.session.execute(text(ddl))
+                    db.session.commit()
+                except Exception:
+                    # SQLite без FTS5 — поиск останется на LIKE; недосозданное не оставляем
+                    db.session.rollback()
+                    for ddl in _ARTICLE_FTS_DROP:
+                        try:
+                            db.session.execute(text(ddl))
+                        except Exception:
+                            pass
+                    db.session.commit()
+
+            if migrations:
+                db.session.execute(text("DELETE FROM schema_meta WHERE key = 'version'"))
+                db.session.execute(
+                    text("INSERT INTO schema_meta (key, value) VALUES ('version', :v)"),
+                    {"v": str(SCHEMA_VERSION)},
+                )
+            db.session.commit()
+
+            _fts_enabled = db.engine.dialect.name == "sqlite" and db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'article_fts'"
+            )).first() is not None
         finally:
             fcntl.flock(fd, fcntl.LOCK_UN)
             os.close(fd)
 
     # --- Кеш пользователей для логина ---
+    # parse_users_file сам кеширует разбор по mtime; TTL экономит ещё и stat на каждый вызов
     app._users_cache = {}
-    app._users_mtime = None
+    app._users_cache_expiry = 0.0
+    _USERS_CACHE_TTL = 2.0  # секунд между проверками mtime файла пользователей
 
     def load_users():
-        users_file = app.config["USERS_FILE"]
-        try:
-            mtime = os.path.getmtime(users_file)
-        except OSError:
-            mtime = None
-        if mtime != app._users_mtime:
-            app._users_cache = parse_users_file(users_file)
-            app._users_mtime = mtime
+        now = time.monotonic()
+        if now < app._users_cache_expiry:
+            return app._users_cache
+        app._users_cache = parse_users_file(app.config["USERS_FILE"])
+        app._users_cache_expiry = now + _USERS_CACHE_TTL
         return app._users_cache
 
+    # --- Кеш навигации по разделам ---
+    # Дерево разделов меняется редко, а нужно на каждой странице. Держим его в процессе,
+    # а версию — в schema_meta: её меняет любая правка разделов/подразделов, так что
+    # другие воркеры gunicorn тоже увидят изменения (ценой одного SELECT по ключу).
+    app._nav_cache = (None, None)
+
+    def _bump_nav_version():
+        """Инвалидирует кеш навигации; вызывать перед commit правок разделов/подразделов."""
+        v = uuid.uuid4().hex
+        res = db.session.execute(text("UPDATE schema_meta SET value = :v WHERE key = 'nav_version'"), {"v": v})
+        if not res.rowcount:
+            db.session.execute(text("INSERT INTO schema_meta (key, value) VALUES ('nav_version', :v)"), {"v": v})
+
+    def _nav_sections():
+        version = db.session.execute(text("SELECT value FROM schema_meta WHERE key = 'nav_version'")).scalar()
+        cached_version, cached = app._nav_cache
+        if cached is not None and cached_version == version:
+            return cached
+        sections = (Section.query
+                    .options(selectinload(Section.subsections))
+                    .filter(Section.is_deleted.is_(False))
+                    .order_by(Section.title)
+                    .all())
+        # храним простые словари, а не ORM-объекты: они переживут закрытие сессии запроса
+        nav = [
+            {
+                "id": s.id,
+                "title": s.title,
+                "subsections": [{"id": ss.id, "title": ss.title} for ss in s.subsections],
+            }
+            for s in sections
+        ]
+        app._nav_cache = (version, nav)
+        return nav
+
     # --- Jinja context ---
     @app.context_processor
     def inject_globals():
         try:
-            sections_nav = Section.query.filter(Section.is_deleted.is_(False)).order_by(Section.title).all()
+            sections_nav = _nav_sections()
         except Exception:
             sections_nav = []
         return {
@@ -390,7 +671,41 @@ def create_app():
             "nav_sections": sections_nav,
         }
 
+    # --- RAG: пересборка чанков в фоне, чтобы не держать ответ на сохранении ---
+    _rag_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="rag")
+
+    def _rebuild_chunks_async(article_id: int):
+        def _run():
+            # своя сессия БД: контекст приложения в потоке пула
+            with app.app_context():
+                try:
+                    a = db.session.get(Article, article_id)
+                    if a is not None:
+                        rebuild_article_chunks(a)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("RAG rebuild failed for article %s", article_id)
+        _rag_executor.submit(_run)
+
+    def _rebuild_all_chunks_async():
+        def _run():
+            with app.app_context():
+                try:
+                    rebuild_all_chunks()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("RAG full rebuild failed")
+        _rag_executor.submit(_run)
+
     # --- Helpers ---
+    def _upload_names() -> set:
+        # один листинг каталога вместо os.path.exists на каждый файл
+        try:
+            with os.scandir(app.config["UPLOAD_FOLDER"]) as it:
+                return {e.name for e in it}
+        except FileNotFoundError:
+            return set()
+
     def _snapshot_attachments(article: Article):
         data = []
         for att in article.attachments:
@@ -402,37 +717,48 @@ def create_app():
             })
         return data
 
-    def sync_attachments_from_content(article: Article, html: str):
-        """Регистрируем в БД вложения, которые встречаются в тексте (src/href=<UPLOAD_URL>/...)."""
-        try:
-            from bs4 import BeautifulSoup
-        except Exception:
-            return  # если bs4 не установлен
-        soup = BeautifulSoup(html or "", "html.parser")
-        files = set()
-        upload_url = app.config["UPLOAD_URL"].rstrip("/")
-        pattern = re.compile(rf"^{re.escape(upload_url)}/(.+)$")
-
-        for tag in soup.find_all(["img", "video", "audio", "source", "a"]):
-            src = tag.get("src") or tag.get("href")
-            if not src:
+    def _snapshot_attachments_json(article: Article):
+        """Снимок вложений для ревизии; без вложений — None (откат трактует его как пустой список)."""
+        data = _snapshot_attachments(article)
+        return _json_bytes(data).decode("utf-8") if data else None
+
+    def _attachments_from_request_files(article: Article) -> list[Attachment]:
+        """Сохраняет файлы из input[type=file] в /uploads и возвращает (ещё не добавленные) Attachment."""
+        atts = []
+        for file in request.files.getlist("files"):
+            if not file or not file.filename:
                 continue
-            m = pattern.match(src.strip())
-            if m:
-                files.add(m.group(1))
+            ext = os.path.splitext(file.filename)[1]
+            unique = f"{uuid.uuid4().hex}{ext}"
+            fname = secure_filename(unique)
+            path = os.path.join(app.config["UPLOAD_FOLDER"], fname)
+            _save_upload(file, path)
+            atts.append(Attachment(
+                article_id=article.id, filename=fname, mime_type=file.mimetype,
+                uploaded_by_login=session["user"]["login"]
+            ))
+        return atts
 
-        if not files:
-            return
+    def sync_attachments_from_content(article: Article, html: str, existing: set[str]) -> list[Attachment]:
+        """
+        Вложения, которые встречаются в тексте (src/href=<UPLOAD_URL>/...), но ещё не привязаны
+        к статье (existing — уже известные имена файлов). Ничего не пишет в БД: сохранение и
+        commit — на вызывающем, одной транзакцией со статьёй.
+        """
+        if not html or not html.strip():
+            return []
+        # HTML уже прошёл через bleach — атрибуты предсказуемы, DOM строить незачем
+        files = {html_lib.unescape(m.group(2)) for m in _UPLOAD_SRC_HREF_RE.finditer(html)}
 
-        existing = {att.filename for att in article.attachments}
-        for fn in files - existing:
-            db.session.add(Attachment(
+        return [
+            Attachment(
                 article_id=article.id,
                 filename=fn,
                 mime_type=mimetypes.guess_type(fn)[0] or "application/octet-stream",
                 uploaded_by_login=session["user"]["login"],
-            ))
-        db.session.commit()
+            )
+            for fn in files - existing
+        ]
 
     # --- Static uploads serving ---
     @app.route("/uploads/<path:filename>")
@@ -466,34 +792,52 @@ def create_app():
         flash("Вы вышли из системы.", "info")
         return redirect(url_for("login"))
 
+    def _search_articles_fts(q: str):
+        """Поиск по индексу article_fts; None — если запрос не удался (тогда ищем через LIKE)."""
+        # каждое слово запроса — префикс в кавычках, чтобы пользовательский ввод не трактовался как синтаксис FTS5
+        match = " ".join('"{}"*'.format(t.replace('"', '""')) for t in q.split())
+        try:
+            return (Article.query
+                    .from_statement(text(
+                        "SELECT a.* FROM articles a"
+                        " JOIN article_fts f ON f.rowid = a.id"
+                        " WHERE article_fts MATCH :q AND NOT a.is_deleted"
+                        " ORDER BY a.updated_at DESC"
+                    ))
+                    .params(q=match)
+                    .all())
+        except Exception:
+            db.session.rollback()
+            return None
+
     # --- Pages ---
     @app.route("/", methods=["GET"])
     @login_required
     def index():
         q = (request.args.get("q") or "").strip()
         user_login = session["user"]["login"]
-        fav_ids = [f.article_id for f in Favorite.query.filter_by(user_login=user_login).all()]
-        favorites = []
-        if fav_ids:
-            favorites = (Article.query
-                 .filter(Article.id.in_(fav_ids), Article.is_deleted.is_(False))
-                 .order_by(Article.updated_at.desc())
-                 .all())
+        # избранное одним запросом: id берём подзапросом, без загрузки объектов Favorite
+        fav_ids = db.session.query(Favorite.article_id).filter(Favorite.user_login == user_login)
+        favorites = (Article.query
+             .filter(Article.id.in_(fav_ids), Article.is_deleted.is_(False))
+             .order_by(Article.updated_at.desc())
+             .all())
         
         if q:
-            articles = (Article.query
-                        .filter(
-                            (Article.title.ilike(f"%{q}%")) | (Article.content.ilike(f"%{q}%")),
-                            Article.is_deleted.is_(False))
-                        .order_by(Article.updated_at.desc())
-                        .all())
+            articles = _search_articles_fts(q) if _fts_enabled else None
+            if articles is None:
+                articles = (Article.query
+                            .filter(
+                                (Article.title.ilike(f"%{q}%")) | (Article.content.ilike(f"%{q}%")),
+                                Article.is_deleted.is_(False))
+                            .order_by(Article.updated_at.desc())
+                            .all())
         else:
             articles = (Article.query
                         .filter(Article.is_deleted.is_(False))
                         .order_by(Article.updated_at.desc())
                         .limit(10)
                         .all())
-        sections = Section.query.order_by(Section.title).all()
         return render_template("index.html", articles=articles, favorites=favorites, q=q)
 
     @app.route("/about")
@@ -513,6 +857,7 @@ def create_app():
                 return render_template("section_form.html")
             s = Section(title=title, description=desc, created_by_login=session["user"]["login"])
             db.session.add(s)
+            _bump_nav_version()
             db.session.commit()
             flash("Раздел создан.", "success")
             return redirect(url_for("section_detail", section_id=s.id))
@@ -538,6 +883,7 @@ def create_app():
                 return render_template("subsection_form.html", section=s)
             ss = Subsection(section_id=s.id, title=title, description=desc, created_by_login=session["user"]["login"])
             db.session.add(ss)
+            _bump_nav_version()
             db.session.commit()
             flash("Подраздел создан.", "success")
             return redirect(url_for("subsection_detail", subsection_id=ss.id))
@@ -568,6 +914,7 @@ def create_app():
             s.description = desc
             s.updated_at = datetime.utcnow()
             s.updated_by_login = session["user"]["login"]
+            _bump_nav_version()
             db.session.commit()
             flash("Раздел обновлён.", "success")
             return redirect(url_for("section_detail", section_id=s.id))
@@ -589,6 +936,7 @@ def create_app():
             ss.description = desc
             ss.updated_at = datetime.utcnow()
             ss.updated_by_login = session["user"]["login"]
+            _bump_nav_version()
             db.session.commit()
             flash("Подраздел обновлён.", "success")
             return redirect(url_for("subsection_detail", subsection_id=ss.id))
@@ -604,7 +952,6 @@ def create_app():
         if request.method == "POST":
             title = request.form.get("title", "").strip()
             content = sanitize_html(request.form.get("content", ""))
-            content = localize_external_media(content)
             if not title:
                 flash("Название статьи обязательно.", "error")
                 return render_template("article_form.html", subsection=ss, article=None)
@@ -617,39 +964,28 @@ def create_app():
                 updated_by_login=session["user"]["login"],
             )
             db.session.add(a_obj)
-            db.session.flush()
+            db.session.flush()  # нужен a_obj.id
 
             # загрузка файлов (если были приложены через input[type=file])
-            files = request.files.getlist("files")
-            for file in files:
-                if not file or not file.filename:
-                    continue
-                ext = os.path.splitext(file.filename)[1]
-                unique = f"{uuid.uuid4().hex}{ext}"
-                fname = secure_filename(unique)
-                path = os.path.join(app.config["UPLOAD_FOLDER"], fname)
-                file.save(path)
-                db.session.add(Attachment(
-                    article_id=a_obj.id, filename=fname, mime_type=file.mimetype,
-                    uploaded_by_login=session["user"]["login"]
-                ))
-            db.session.commit()
-
-            # синхронизация вложений, встречающихся внутри HTML
-            sync_attachments_from_content(a_obj, a_obj.content)
+            # + вложения, встречающиеся внутри HTML — одной пачкой
+            new_atts = _attachments_from_request_files(a_obj)
+            new_atts += sync_attachments_from_content(
+                a_obj, a_obj.content, {att.filename for att in new_atts}
+            )
+            db.session.bulk_save_objects(new_atts)
 
-            # первая ревизия (с снапшотом вложений)
+            # первая ревизия (с снапшотом вложений); всё сохраняется одним commit
             rev = ArticleRevision(
                 article_id=a_obj.id,
                 content=a_obj.content,
                 editor_login=session["user"]["login"],
-                attachments_json=json.dumps(_snapshot_attachments(a_obj), ensure_ascii=False),
+                attachments_json=_snapshot_attachments_json(a_obj),
             )
             db.session.add(rev)
             db.session.commit()
 
             # RAG
-            rebuild_article_chunks(a_obj)
+            _rebuild_chunks_async(a_obj.id)
 
             flash("Статья создана.", "success")
             return redirect(url_for("article_detail", article_id=a_obj.id))
@@ -658,7 +994,7 @@ def create_app():
     @app.route("/articles/<int:article_id>")
     @login_required
     def article_detail(article_id):
-        a_obj = Article.query.get_or_404(article_id)
+        a_obj = Article.query.options(joinedload(Article.subsection)).get_or_404(article_id)
         is_fav = Favorite.query.filter_by(
             article_id=a_obj.id,
             user_login=session["user"]["login"]
@@ -668,51 +1004,41 @@ def create_app():
     @app.route("/articles/<int:article_id>/edit", methods=["GET", "POST"])
     @login_required
     def edit_article(article_id):
-        a_obj = Article.query.get_or_404(article_id)
+        a_obj = Article.query.options(joinedload(Article.subsection)).get_or_404(article_id)
         if request.method == "POST":
             title = request.form.get("title", "").strip()
             content = sanitize_html(request.form.get("content", ""))
-            content = localize_external_media(content)
             if not title:
                 flash("Название статьи обязательно.", "error")
                 return render_template("article_form.html", subsection=a_obj.subsection, article=a_obj)
 
-            # ревизия текущего состояния (контент + вложения)
-            prev = ArticleRevision(
-                article_id=a_obj.id,
-                content=a_obj.content,
-                editor_login=session["user"]["login"],
-                attachments_json=json.dumps(_snapshot_attachments(a_obj), ensure_ascii=False),
-            )
-            db.session.add(prev)
+            # загрузка дополнительных файлов (в БД попадут ниже, одной пачкой)
+            new_atts = _attachments_from_request_files(a_obj)
+
+            # ревизия текущего состояния (контент + вложения) — только если что-то меняется:
+            # пересохранение без правок или правка одного заголовка ревизию не плодят
+            if content != a_obj.content or new_atts:
+                prev = ArticleRevision(
+                    article_id=a_obj.id,
+                    content=a_obj.content,
+                    editor_login=session["user"]["login"],
+                    attachments_json=_snapshot_attachments_json(a_obj),
+                )
+                db.session.add(prev)
 
             a_obj.title = title
             a_obj.content = content
             a_obj.updated_by_login = session["user"]["login"]
             a_obj.updated_at = datetime.utcnow()
-            db.session.commit()
 
-            # загрузка дополнительных файлов
-            files = request.files.getlist("files")
-            for file in files:
-                if not file or not file.filename:
-                    continue
-                ext = os.path.splitext(file.filename)[1]
-                unique = f"{uuid.uuid4().hex}{ext}"
-                fname = secure_filename(unique)
-                path = os.path.join(app.config["UPLOAD_FOLDER"], fname)
-                file.save(path)
-                db.session.add(Attachment(
-                    article_id=a_obj.id, filename=fname, mime_type=file.mimetype,
-                    uploaded_by_login=session["user"]["login"]
-                ))
+            # + вложения, встречающиеся в HTML
+            known = {att.filename for att in a_obj.attachments} | {att.filename for att in new_atts}
+            new_atts += sync_attachments_from_content(a_obj, a_obj.content, known)
+            db.session.bulk_save_objects(new_atts)
             db.session.commit()
 
-            # синхронизация вложений, встречающихся в HTML
-            sync_attachments_from_content(a_obj, a_obj.content)
-
             # RAG
-            rebuild_article_chunks(a_obj)
+            _rebuild_chunks_async(a_obj.id)
 
             flash("Статья обновлена.", "success")
             return redirect(url_for("article_detail", article_id=a_obj.id))
@@ -735,10 +1061,9 @@ def create_app():
             article_id=a_obj.id,
             content=a_obj.content,
             editor_login=session["user"]["login"],
-            attachments_json=json.dumps(_snapshot_attachments(a_obj), ensure_ascii=False),
+            attachments_json=_snapshot_attachments_json(a_obj),
         )
         db.session.add(prev)
-        db.session.flush()
 
         # откат контента
         a_obj.content = rev.content
@@ -749,41 +1074,45 @@ def create_app():
         target = []
         if rev.attachments_json:
             try:
-                target = json.loads(rev.attachments_json)
+                target = _json_loads(rev.attachments_json)
             except Exception:
                 target = []
 
-        # удаляем текущие привязки и восстанавливаем из снапшота
-        Attachment.query.filter_by(article_id=a_obj.id).delete()
-        db.session.flush()
+        # удаляем текущие привязки и восстанавливаем из снапшота — Core-запросами,
+        # в той же транзакции, что и ревизия с контентом
+        db.session.execute(
+            delete(Attachment).where(Attachment.article_id == a_obj.id),
+            execution_options={"synchronize_session": False},
+        )
 
         missing = 0
+        rows = []
+        existing = _upload_names() if target else set()
         for item in target:
             fname = item.get("filename")
-            mtype = item.get("mime_type")
-            upl_by = item.get("uploaded_by_login") or session["user"]["login"]
             upl_at = datetime.utcnow()
             if item.get("uploaded_at"):
                 try:
                     upl_at = datetime.fromisoformat(item["uploaded_at"])
                 except Exception:
                     pass
-            fpath = os.path.join(app.config["UPLOAD_FOLDER"], fname) if fname else None
-            if not fname or not os.path.exists(fpath):
+            if not fname or fname not in existing:
                 missing += 1
                 continue
-            db.session.add(Attachment(
-                article_id=a_obj.id,
-                filename=fname,
-                mime_type=mtype,
-                uploaded_by_login=upl_by,
-                uploaded_at=upl_at,
-            ))
+            rows.append({
+                "article_id": a_obj.id,
+                "filename": fname,
+                "mime_type": item.get("mime_type"),
+                "uploaded_by_login": item.get("uploaded_by_login") or session["user"]["login"],
+                "uploaded_at": upl_at,
+            })
+        if rows:
+            db.session.execute(Attachment.__table__.insert(), rows)
 
         db.session.commit()
 
         # RAG
-        rebuild_article_chunks(a_obj)
+        _rebuild_chunks_async(a_obj.id)
 
         if missing:
             flash(f"Откат выполнен, но {missing} вложений отсутствуют на диске и не были восстановлены.", "warning")
@@ -831,18 +1160,8 @@ def create_app():
             flash("Для окончательного удаления сначала поместите статью в корзину.", "warning")
             return redirect(url_for("article_detail", article_id=article_id))
     
-        # удалить файлы с диска (best-effort)
-        removed = 0
-        for att in list(a_obj.attachments):
-            try:
-                fpath = os.path.join(app.config["UPLOAD_FOLDER"], att.filename)
-                if os.path.exists(fpath):
-                    os.remove(fpath)
-                    removed += 1
-            except Exception:
-                pass
-
-        db.session.delete(a_obj)  # каскадно удалит attachments/revisions/chunks
+        # удалить файлы с диска (best-effort) и саму статью со всеми потомками
+        removed = _purge_article(a_obj)
         db.session.commit()
         flash(f"Статья и вложения удалены окончательно (файлов удалено: {removed}).", "success")
         return redirect(url_for("admin_trash"))
@@ -869,34 +1188,94 @@ def create_app():
 
     # ---------- Soft delete helpers ----------
 
-    def _soft_delete_article(a_obj, login):
-        if a_obj.is_deleted:
-            return
-        a_obj.is_deleted = True
-        a_obj.deleted_at = datetime.utcnow()
-        a_obj.deleted_by_login = login
+    def _purge_article_children(article_ids):
+        """
+        Снимает с диска файлы вложений статей article_ids (список или подзапрос id)
+        и удаляет их потомков. Возвращает число удалённых файлов.
+        """
+        removed = 0
+        filenames = set(db.session.execute(
+            select(Attachment.filename).where(Attachment.article_id.in_(article_ids))
+        ).scalars())
+        if filenames:
+            # на файл могут ссылаться и другие статьи (ссылка скопирована в их текст) —
+            # такие файлы оставляем
+            filenames -= set(db.session.execute(
+                select(Attachment.filename).where(
+                    Attachment.filename.in_(filenames),
+                    Attachment.article_id.not_in(article_ids),
+                )
+            ).scalars())
+        # один листинг каталога: отсутствующие на диске файлы даже не пытаемся удалять
+        if filenames:
+            filenames &= _upload_names()
+        for fname in filenames:
+            try:
+                os.unlink(os.path.join(app.config["UPLOAD_FOLDER"], fname))
+                removed += 1
+            except FileNotFoundError:
+                pass  # успели удалить между листингом и unlink
+            except Exception:
+                pass
+            _release_blob(fname)
+        # Потомков удаляем по одному DELETE на таблицу, не загружая их в сессию
+        # (passive_deletes). На ON DELETE CASCADE не полагаемся: в БД, созданных
+        # до его появления в моделях, внешние ключи остались без него.
+        for model in (Attachment, ArticleRevision, Chunk, Favorite):
+            db.session.execute(
+                delete(model).where(model.article_id.in_(article_ids)),
+                execution_options={"synchronize_session": False},
+            )
+        return removed
 
-    def _restore_article(a_obj):
-        if not a_obj.is_deleted:
+    def _release_blob(fname):
+        """Удаляет общий блоб загрузки, если на него не осталось других имён."""
+        blob = _blob_path(fname)
+        if blob is None:
             return
-        a_obj.is_deleted = False
-        a_obj.deleted_at = None
-        a_obj.deleted_by_login = None
+        try:
+            if os.stat(blob).st_nlink <= 1:
+                os.unlink(blob)
+        except OSError:
+            pass
 
     def _purge_article(a_obj):
         # снять файлы с диска и удалить объект
-        removed = 0
-        for att in list(a_obj.attachments):
-            try:
-                fpath = os.path.join(app.config["UPLOAD_FOLDER"], att.filename)
-                if os.path.exists(fpath):
-                    os.remove(fpath)
-                    removed += 1
-            except Exception:
-                pass
+        removed = _purge_article_children([a_obj.id])
         db.session.delete(a_obj)
         return removed
 
+    def _ids_under_section(section_id, active_only=False):
+        """
+        Подзапросы (id подразделов, id статей) раздела — для bulk UPDATE/DELETE
+        по всему дереву без загрузки строк. active_only — только не удалённые подразделы.
+        """
+        subsection_ids = select(Subsection.id).where(Subsection.section_id == section_id)
+        if active_only:
+            subsection_ids = subsection_ids.where(Subsection.is_deleted.is_(False))
+        article_ids = select(Article.id).where(Article.subsection_id.in_(subsection_ids))
+        return subsection_ids, article_ids
+
+    # Каскад по статьям/подразделам — одним UPDATE на уровень, без загрузки строк в сессию
+    # (вызывающий сразу делает commit, поэтому synchronize_session=False безопасен)
+    def _soft_delete_articles_where(login, *criteria):
+        (Article.query
+         .filter(Article.is_deleted.is_(False), *criteria)
+         .update({
+             Article.is_deleted: True,
+             Article.deleted_at: datetime.utcnow(),
+             Article.deleted_by_login: login,
+         }, synchronize_session=False))
+
+    def _restore_articles_where(*criteria):
+        (Article.query
+         .filter(Article.is_deleted.is_(True), *criteria)
+         .update({
+             Article.is_deleted: False,
+             Article.deleted_at: None,
+             Article.deleted_by_login: None,
+         }, synchronize_session=False))
+
     def _soft_delete_subsection(ss, login):
         if ss.is_deleted:
             return
@@ -904,8 +1283,7 @@ def create_app():
         ss.deleted_at = datetime.utcnow()
         ss.deleted_by_login = login
         # все статьи в подразделе
-        for a in Article.query.filter_by(subsection_id=ss.id).all():
-            _soft_delete_article(a, login)
+        _soft_delete_articles_where(login, Article.subsection_id == ss.id)
 
     def _restore_subsection(ss):
         if not ss.is_deleted:
@@ -913,13 +1291,15 @@ def create_app():
         ss.is_deleted = False
         ss.deleted_at = None
         ss.deleted_by_login = None
-        for a in Article.query.filter_by(subsection_id=ss.id).all():
-            _restore_article(a)
+        _restore_articles_where(Article.subsection_id == ss.id)
 
     def _purge_subsection(ss):
-        total_removed = 0
-        for a in Article.query.filter_by(subsection_id=ss.id).all():
-            total_removed += _purge_article(a)
+        article_ids = select(Article.id).where(Article.subsection_id == ss.id)
+        total_removed = _purge_article_children(article_ids)
+        db.session.execute(
+            delete(Article).where(Article.subsection_id == ss.id),
+            execution_options={"synchronize_session": False},
+        )
         db.session.delete(ss)
         return total_removed
 
@@ -929,9 +1309,17 @@ def create_app():
         s.is_deleted = True
         s.deleted_at = datetime.utcnow()
         s.deleted_by_login = login
-        # все подразделы + их статьи
-        for ss in Subsection.query.filter_by(section_id=s.id).all():
-            _soft_delete_subsection(ss, login)
+        # все подразделы + их статьи (уже удалённые подразделы не трогаем);
+        # сначала статьи — подзапрос смотрит на ещё не удалённые подразделы
+        subsection_ids, article_ids = _ids_under_section(s.id, active_only=True)
+        _soft_delete_articles_where(login, Article.id.in_(article_ids))
+        (Subsection.query
+         .filter(Subsection.id.in_(subsection_ids))
+         .update({
+             Subsection.is_deleted: True,
+             Subsection.deleted_at: datetime.utcnow(),
+             Subsection.deleted_by_login: login,
+         }, synchronize_session=False))
 
     def _restore_section(s):
         if not s.is_deleted:
@@ -939,13 +1327,25 @@ def create_app():
         s.is_deleted = False
         s.deleted_at = None
         s.deleted_by_login = None
-        for ss in Subsection.query.filter_by(section_id=s.id).all():
-            _restore_subsection(ss)
+        subsection_ids, article_ids = _ids_under_section(s.id)
+        _restore_articles_where(Article.id.in_(article_ids))
+        (Subsection.query
+         .filter(Subsection.id.in_(subsection_ids))
+         .update({
+             Subsection.is_deleted: False,
+             Subsection.deleted_at: None,
+             Subsection.deleted_by_login: None,
+         }, synchronize_session=False))
 
     def _purge_section(s):
-        total_removed = 0
-        for ss in Subsection.query.filter_by(section_id=s.id).all():
-            total_removed += _purge_subsection(ss)
+        subsection_ids, article_ids = _ids_under_section(s.id)
+        total_removed = _purge_article_children(article_ids)
+        # статьи раньше подразделов: подзапросы смотрят на ещё существующие подразделы
+        for stmt in (
+            delete(Article).where(Article.subsection_id.in_(subsection_ids)),
+            delete(Subsection).where(Subsection.section_id == s.id),
+        ):
+            db.session.execute(stmt, execution_options={"synchronize_session": False})
         db.session.delete(s)
         return total_removed
 
@@ -958,6 +1358,7 @@ def create_app():
             flash("Подраздел уже в корзине.", "info")
             return redirect(url_for("subsection_detail", subsection_id=subsection_id))
         _soft_delete_subsection(ss, session["user"]["login"])
+        _bump_nav_version()
         db.session.commit()
         flash("Подраздел и его статьи перемещены в корзину.", "success")
         return redirect(url_for("section_detail", section_id=ss.section_id))
@@ -970,6 +1371,7 @@ def create_app():
             flash("Подраздел не в корзине.", "info")
             return redirect(url_for("subsection_detail", subsection_id=subsection_id))
         _restore_subsection(ss)
+        _bump_nav_version()
         db.session.commit()
         flash("Подраздел и его статьи восстановлены.", "success")
         return redirect(url_for("subsection_detail", subsection_id=subsection_id))
@@ -982,6 +1384,7 @@ def create_app():
             flash("Для окончательного удаления сначала поместите подраздел в корзину.", "warning")
             return redirect(url_for("subsection_detail", subsection_id=subsection_id))
         removed = _purge_subsection(ss)
+        _bump_nav_version()
         db.session.commit()
         flash(f"Подраздел удалён окончательно. Файлов удалено: {removed}.", "success")
         return redirect(url_for("admin_trash"))
@@ -1012,6 +1415,7 @@ def create_app():
             flash("Раздел уже в корзине.", "info")
             return redirect(url_for("section_detail", section_id=section_id))
         _soft_delete_section(s, session["user"]["login"])
+        _bump_nav_version()
         db.session.commit()
         flash("Раздел со всеми подразделами и статьями перемещён в корзину.", "success")
         return redirect(url_for("index"))
@@ -1024,6 +1428,7 @@ def create_app():
             flash("Раздел не в корзине.", "info")
             return redirect(url_for("section_detail", section_id=section_id))
         _restore_section(s)
+        _bump_nav_version()
         db.session.commit()
         flash("Раздел со всеми потомками восстановлен.", "success")
         return redirect(url_for("section_detail", section_id=section_id))
@@ -1036,6 +1441,7 @@ def create_app():
             flash("Для окончательного удаления сначала поместите раздел в корзину.", "warning")
             return redirect(url_for("section_detail", section_id=section_id))
         removed = _purge_section(s)
+        _bump_nav_version()
         db.session.commit()
         flash(f"Раздел и все потомки удалены окончательно. Файлов удалено: {removed}.", "success")
         return redirect(url_for("admin_trash"))
@@ -1077,9 +1483,7 @@ def create_app():
             }
             ext = mapping.get(ctype, mimetypes.guess_extension(ctype) or "")
     
-        fname = secure_filename(f"{uuid.uuid4().hex}{ext}")
-        path = os.path.join(app.config["UPLOAD_FOLDER"], fname)
-        file.save(path)
+        fname = _save_upload_by_hash(file, ext)
     
         a_id = request.form.get("article_id")
         if a_id:
@@ -1089,7 +1493,7 @@ def create_app():
                     filename=fname,
                     mime_type=ctype or file.mimetype,
                     uploaded_by_login=session["user"]["login"],
-                ))  
+                ))
                 db.session.commit()
             except Exception:
                 db.session.rollback()
@@ -1119,61 +1523,91 @@ def create_app():
             "path": f"/sections/{s.id if s else ''}/subsections/{ss.id if ss else ''}/articles/{a.id}",
         }
 
+    def _export_chunks_query():
+        """Чанки неудалённых статей; статья/подраздел/раздел подгружаются тем же запросом (без N+1)."""
+        # Фильтр по is_deleted — через coalesce (столбец NOT NULL, смысл тот же), чтобы SQLite
+        # не выбрал индекс по articles.is_deleted внешним циклом: тогда чанки пришлось бы
+        # сортировать во временном B-дереве целиком. Так план — проход по chunks в порядке
+        # rowid (id > after_id) с поиском статьи по первичному ключу: строки идут потоком.
+        return (Chunk.query
+                .join(Article, Article.id == Chunk.article_id)
+                .options(contains_eager(Chunk.article)
+                         .joinedload(Article.subsection)
+                         .joinedload(Subsection.section))
+                .filter(func.coalesce(Article.is_deleted, False).is_(False))
+                .order_by(Chunk.id))
+
     @app.route("/api/chunks.ndjson")
     @login_required
     def api_chunks_ndjson():
         def generate():
-            q = (Chunk.query
-                 .join(Article, Article.id == Chunk.article_id)
-                 .filter(Article.is_deleted.is_(False))
-                 .order_by(Chunk.id)
-                 .yield_per(200))
+            q = _export_chunks_query().yield_per(200)
             for ch in q:
-                yield json.dumps(_chunk_to_dict(ch), ensure_ascii=False) + "\n"
+                yield _json_bytes(_chunk_to_dict(ch)) + b"\n"
         return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
     @app.route("/api/chunks.json")
     @login_required
     def api_chunks_json():
-        chunks = [
-            _chunk_to_dict(ch) for ch in
-            Chunk.query.join(Article, Article.id == Chunk.article_id)
-            .filter(Article.is_deleted.is_(False))
-            .order_by(Chunk.id).limit(5000).all()
-        ]
-        return jsonify(chunks)
+        # keyset-пагинация: ?after_id=<последний chunk_id прошлой страницы>&limit=
+        after_id = request.args.get("after_id", 0, type=int)
+        limit = max(1, min(request.args.get("limit", 1000, type=int), 5000))
+        q = _export_chunks_query().filter(Chunk.id > after_id)
+
+        # курсор следующей страницы — id последнего чанка полной страницы (по индексу, без строк)
+        next_after = (q.with_entities(Chunk.id).order_by(None).order_by(Chunk.id)
+                      .offset(limit - 1).limit(1).scalar())
+
+        def generate():
+            yield b"["
+            for i, ch in enumerate(q.limit(limit).yield_per(200)):
+                yield (b"," if i else b"") + _json_bytes(_chunk_to_dict(ch))
+            yield b"]\n"
+        resp = Response(stream_with_context(generate()), mimetype="application/json")
+        if next_after is not None:
+            resp.headers["X-Next-After-Id"] = str(next_after)
+        return resp
 
     @app.route("/api/articles.json")
     @login_required
     def api_articles_json():
-        data = []
-        for a in Article.query.filter(Article.is_deleted.is_(False)).order_by(Article.id).all():
-            ss = a.subsection
-            s = ss.section if ss else None
-            try:
-                from bs4 import BeautifulSoup
-                text = BeautifulSoup(a.content or "", "html.parser").get_text("\n")
-            except Exception:
-                text = ""
-            data.append({
-                "article_id": a.id,
-                "article_title": a.title,
-                "html": a.content,
-                "text": text,
-                "section_title": s.title if s else None,
-                "subsection_title": ss.title if ss else None,
-                "created_at": a.created_at.isoformat() if a.created_at else None,
-                "updated_at": a.updated_at.isoformat() if a.updated_at else None,
-                "author": a.created_by_login,
-                "last_editor": a.updated_by_login or a.created_by_login,
-            })
-        return jsonify(data)
+        # JSON-массив отдаём потоком: статьи не собираются в памяти целиком,
+        # а плейнтекст берётся из content_text (считается при пересборке чанков)
+        def generate():
+            q = (Article.query
+                 .options(joinedload(Article.subsection).joinedload(Subsection.section))
+                 .filter(Article.is_deleted.is_(False))
+                 .order_by(Article.id)
+                 .yield_per(200))
+            yield b"["
+            for i, a in enumerate(q):
+                ss = a.subsection
+                s = ss.section if ss else None
+                plain = a.content_text
+                if plain is None:
+                    # ещё не посчитан (старая статья или пересборка в фоне не закончилась)
+                    plain = html_to_text(a.content or "")
+                item = {
+                    "article_id": a.id,
+                    "article_title": a.title,
+                    "html": a.content,
+                    "text": plain,
+                    "section_title": s.title if s else None,
+                    "subsection_title": ss.title if ss else None,
+                    "created_at": a.created_at.isoformat() if a.created_at else None,
+                    "updated_at": a.updated_at.isoformat() if a.updated_at else None,
+                    "author": a.created_by_login,
+                    "last_editor": a.updated_by_login or a.created_by_login,
+                }
+                yield (b"," if i else b"") + _json_bytes(item)
+            yield b"]\n"
+        return Response(stream_with_context(generate()), mimetype="application/json")
 
     @app.route("/admin/rag/rebuild", methods=["POST"])
     @admin_required
     def admin_rag_rebuild():
-        rebuild_all_chunks()
-        flash("RAG-чанки пересобраны для всех статей.", "success")
+        _rebuild_all_chunks_async()
+        flash("Пересборка RAG-чанков для всех статей запущена в фоне.", "success")
         return redirect(url_for("index"))
 
     return app
@@ -1,10 +1,33 @@
+import os
+import sqlite3
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import validates
+
+try:
+    import zstandard
+except ImportError:  # без zstandard ревизии пишутся несжатыми в content
+    zstandard = None
 
 
 db = SQLAlchemy()
 
+# Ленивые many-to-one, которые дёргаются в списках/экспортах. С SQLALCHEMY_RAISE_ON_LAZY=1
+# (dev/CI) ленивая подгрузка с SQL падает — так видно N+1; в места использования
+# такие связи надо подгружать явно (.options(joinedload(...)/selectinload(...))).
+_LAZY_HOT = "raise_on_sql" if os.environ.get("SQLALCHEMY_RAISE_ON_LAZY") == "1" else "select"
+
+
+@event.listens_for(Engine, "connect")
+def _sqlite_enable_foreign_keys(dbapi_connection, connection_record):
+    # SQLite по умолчанию не проверяет внешние ключи и не выполняет ON DELETE CASCADE
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
 
 class Section(db.Model):
     __tablename__ = "sections"
@@ -25,11 +48,17 @@ class Section(db.Model):
 
     subsections = db.relationship(
         "Subsection",
-        backref="section",
+        back_populates="section",
         cascade="all, delete-orphan",
+        passive_deletes=True,
         order_by="Subsection.title",
     )
 
+    __table_args__ = (
+        # корзина: is_deleted=True ORDER BY deleted_at DESC
+        db.Index("ix_sections_deleted", "is_deleted", "deleted_at"),
+    )
+
     def __repr__(self):
         return f"<Section {self.id} {self.title!r}>"
 
@@ -38,7 +67,7 @@ class Subsection(db.Model):
     __tablename__ = "subsections"
 
     id = db.Column(db.Integer, primary_key=True)
-    section_id = db.Column(db.Integer, db.ForeignKey("sections.id"), nullable=False)
+    section_id = db.Column(db.Integer, db.ForeignKey("sections.id", ondelete="CASCADE"), nullable=False)
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, default="")
 
@@ -52,13 +81,22 @@ class Subsection(db.Model):
     deleted_at = db.Column(db.DateTime)
     deleted_by_login = db.Column(db.String(64))
 
+    # раздел нужен почти везде, где нужен подраздел (хлебные крошки, корзина)
+    section = db.relationship("Section", back_populates="subsections", lazy="joined")
     articles = db.relationship(
         "Article",
-        backref="subsection",
+        back_populates="subsection",
         cascade="all, delete-orphan",
+        passive_deletes=True,
         order_by="Article.updated_at.desc()",
     )
 
+    __table_args__ = (
+        # подразделы раздела (навигация, каскадное удаление/восстановление)
+        db.Index("ix_subsections_active", "section_id", "is_deleted", "title"),
+        db.Index("ix_subsections_deleted", "is_deleted", "deleted_at"),
+    )
+
     def __repr__(self):
         return f"<Subsection {self.id} {self.title!r}>"
 
@@ -67,10 +105,14 @@ class Article(db.Model):
     __tablename__ = "articles"
 
     id = db.Column(db.Integer, primary_key=True)
-    subsection_id = db.Column(db.Integer, db.ForeignKey("subsections.id"), nullable=False)
+    subsection_id = db.Column(db.Integer, db.ForeignKey("subsections.id", ondelete="CASCADE"), nullable=False)
 
     title = db.Column(db.String(300), nullable=False)
     content = db.Column(db.Text, default="")
+    # плейнтекст content для экспорта и хеш, по которому собраны чанки;
+    # заполняются при пересборке RAG-чанков
+    content_text = db.Column(db.Text)
+    content_sha = db.Column(db.String(32))
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     created_by_login = db.Column(db.String(64))
@@ -82,30 +124,48 @@ class Article(db.Model):
     deleted_at = db.Column(db.DateTime)
     deleted_by_login = db.Column(db.String(64))
 
+    subsection = db.relationship("Subsection", back_populates="articles", lazy=_LAZY_HOT)
     attachments = db.relationship(
         "Attachment",
-        backref="article",
+        back_populates="article",
         cascade="all, delete-orphan",
+        passive_deletes=True,
         order_by="Attachment.uploaded_at",
     )
     revisions = db.relationship(
         "ArticleRevision",
-        backref="article",
+        back_populates="article",
         cascade="all, delete-orphan",
+        passive_deletes=True,
         order_by="ArticleRevision.created_at.desc()",
     )
     chunks = db.relationship(
         "Chunk",
-        backref="article",
+        back_populates="article",
         cascade="all, delete-orphan",
+        passive_deletes=True,
         order_by="Chunk.idx",
     )
     favorites = db.relationship(
         "Favorite",
         back_populates="article",
         cascade="all, delete-orphan",
+        passive_deletes=True,
         lazy="dynamic"
-    )   
+    )
+
+    __table_args__ = (
+        db.Index("ix_articles_active_updated", "is_deleted", db.text("updated_at DESC")),
+        db.Index("ix_articles_deleted", "is_deleted", "deleted_at"),
+        db.Index("ix_articles_subsection_deleted", "subsection_id", "is_deleted"),
+    )
+
+    @validates("content")
+    def _reset_content_text(self, key, value):
+        # плейнтекст устарел — пересчитается при пересборке чанков
+        if value != self.content:
+            self.content_text = None
+        return value
 
     def __repr__(self):
         return f"<Article {self.id} {self.title!r}>"
@@ -115,7 +175,7 @@ class Attachment(db.Model):
     __tablename__ = "attachments"
 
     id = db.Column(db.Integer, primary_key=True)
-    article_id = db.Column(db.Integer, db.ForeignKey("articles.id"), nullable=False)
+    article_id = db.Column(db.Integer, db.ForeignKey("articles.id", ondelete="CASCADE"), nullable=False)
 
     filename = db.Column(db.String(400), nullable=False)
     mime_type = db.Column(db.String(100))
@@ -123,32 +183,67 @@ class Attachment(db.Model):
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     uploaded_by_login = db.Column(db.String(64))
 
+    article = db.relationship("Article", back_populates="attachments")
+
 
 class ArticleRevision(db.Model):
     __tablename__ = "article_revisions"
 
     id = db.Column(db.Integer, primary_key=True)
-    article_id = db.Column(db.Integer, db.ForeignKey("articles.id"), nullable=False)
+    article_id = db.Column(db.Integer, db.ForeignKey("articles.id", ondelete="CASCADE"), nullable=False)
 
-    content = db.Column(db.Text, default="")
+    # текст ревизии хранится сжатым в content_zstd (первый байт — кодек);
+    # столбец content остаётся для старых ревизий и для работы без zstandard
+    _content = db.Column("content", db.Text, default="")
+    content_zstd = db.Column(db.LargeBinary)
     editor_login = db.Column(db.String(64))
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
     # снимок вложений на момент ревизии
     attachments_json = db.Column(db.Text)
 
+    article = db.relationship("Article", back_populates="revisions")
+
+    CODEC_ZSTD = b"z"
+
+    @property
+    def content(self) -> str:
+        packed = self.content_zstd
+        if packed:
+            if packed[:1] != self.CODEC_ZSTD:
+                raise ValueError(f"unknown revision codec {packed[:1]!r}")
+            return zstandard.ZstdDecompressor().decompress(packed[1:]).decode("utf-8")
+        return self._content or ""
+
+    @content.setter
+    def content(self, value: str):
+        value = value or ""
+        if zstandard is None:
+            self._content = value
+            self.content_zstd = None
+            return
+        self._content = None
+        self.content_zstd = self.CODEC_ZSTD + zstandard.ZstdCompressor(level=3).compress(value.encode("utf-8"))
+
 
 class Chunk(db.Model):
     __tablename__ = "chunks"
 
     id = db.Column(db.Integer, primary_key=True)
-    article_id = db.Column(db.Integer, db.ForeignKey("articles.id"), nullable=False)
+    article_id = db.Column(db.Integer, db.ForeignKey("articles.id", ondelete="CASCADE"), nullable=False)
     idx = db.Column(db.Integer, nullable=False, default=0)
     text = db.Column(db.Text, default="")
     tokens = db.Column(db.Integer, default=0)
 
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    article = db.relationship("Article", back_populates="chunks", lazy=_LAZY_HOT)
+
+    __table_args__ = (
+        # чанки статьи по порядку: пересборка, экспорт
+        db.Index("ix_chunks_article_idx", "article_id", "idx"),
+    )
+
 class Favorite(db.Model):
     __tablename__ = "favorites"
 
@@ -1,8 +1,16 @@
 import os
 import re
+import hashlib
 from typing import List
+from concurrent.futures import ProcessPoolExecutor
 from bs4 import BeautifulSoup
+from sqlalchemy import func
+from sqlalchemy.orm.attributes import set_committed_value
 from .models import db, Chunk, Article
+from .utils import BS_PARSER
+
+_WS = re.compile(r"\s+")
+_PARA = re.compile(r"\n\s*\n+")
 
 
 def html_to_text(html: str) -> str:
@@ -10,7 +18,13 @@ def html_to_text(html: str) -> str:
     Очищаем HTML в удобный для индексации плейнтекст.
     Медиа заменяем на маркеры, чтобы сохранялся контекст.
     """
-    soup = BeautifulSoup(html or "", "html.parser")
+    if not html or html.isspace():
+        return ""
+    if "<" not in html and "&" not in html:
+        # ни тегов, ни сущностей (заметки/заглушки) — парсер не нужен
+        return _normalize_lines(html)
+
+    soup = BeautifulSoup(html, BS_PARSER)
 
     # маркеры медиа
     for img in soup.find_all("img"):
@@ -29,64 +43,172 @@ def html_to_text(html: str) -> str:
     for tag in soup(["script", "style"]):
         tag.decompose()
 
-    text = soup.get_text("\n")
-    lines = [re.sub(r"\s+", " ", ln).strip() for ln in text.splitlines()]
-    lines = [ln for ln in lines if ln]
-    return "\n".join(lines)
+    return _normalize_lines(soup.get_text("\n"))
+
+
+def _normalize_lines(text: str) -> str:
+    """Схлопываем пробелы внутри строк и выкидываем пустые строки."""
+    lines = [_WS.sub(" ", ln).strip() for ln in text.splitlines()]
+    return "\n".join(ln for ln in lines if ln)
+
+
+def _paragraph_spans(text: str):
+    """(start, end) абзацев в text — без копирования строк и без пробелов по краям."""
+    pos = 0
+    bounds = [(m.start(), m.end()) for m in _PARA.finditer(text)]
+    bounds.append((len(text), len(text)))
+    for sep_start, sep_end in bounds:
+        start, end = pos, sep_start
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start < end:
+            yield start, end
+        pos = sep_end
 
 
 def chunk_text(text: str, chunk_size: int = 1200, overlap: int = 200) -> List[str]:
     """
     Простая разбивка по абзацам + символам, с перекрытием.
+    Работает на смещениях в исходной строке: подстрока вырезается один раз, при выдаче чанка.
+    Абзац длиннее chunk_size режется на окна (с тем же перекрытием), а не обрезается.
     """
     if not text:
         return []
-    paras = re.split(r"\n\s*\n+", text.strip())
-    chunks, buf, length = [], [], 0
-
-    for p in paras:
-        p = p.strip()
-        if not p:
+    overlap = max(0, min(overlap or 0, chunk_size - 1))
+    step = chunk_size - overlap
+    chunks = []
+    cur_start = cur_end = None
+
+    for p_start, p_end in _paragraph_spans(text):
+        if cur_start is not None and p_end - cur_start <= chunk_size:
+            cur_end = p_end  # абзац помещается в текущий чанк
             continue
-        add_len = (2 if buf else 0) + len(p)
-        if length + add_len <= chunk_size:
-            buf.append(p)
-            length += add_len
+        if cur_start is None:
+            cur_start = p_start
         else:
-            if buf:
-                chunks.append("\n\n".join(buf))
-            if overlap and chunks:
-                tail = chunks[-1][-overlap:]
-                buf = [tail, p]
-                length = len(tail) + 2 + len(p)
-            else:
-                buf = [p]
-                length = len(p)
-
-    if buf:
-        chunks.append("\n\n".join(buf))
+            chunks.append(text[cur_start:cur_end])
+            # перекрытие: следующий чанк начинается с хвоста предыдущего
+            cur_start = max(cur_end - overlap, cur_start) if overlap else p_start
+        cur_end = p_end
+        while cur_end - cur_start > chunk_size:
+            chunks.append(text[cur_start:cur_start + chunk_size])
+            cur_start += step
 
-    return [c[:chunk_size] for c in chunks]
+    if cur_start is not None:
+        chunks.append(text[cur_start:cur_end])
+    return chunks
 
 
-def rebuild_article_chunks(article: Article, chunk_size: int | None = None, overlap: int | None = None):
+def compute_chunks(content: str, chunk_size: int, overlap: int):
     """
-    Пересобираем чанки одной статьи (вызывается после создания/редактирования/отката).
+    Чистая CPU-часть пересборки (без БД): HTML -> (плейнтекст, чанки).
+    Вынесена отдельно, чтобы её можно было гонять в пуле процессов.
     """
+    text = html_to_text(content or "")
+    return text, chunk_text(text, chunk_size, overlap)
+
+
+def _chunk_params(chunk_size: int | None = None, overlap: int | None = None):
     cs = int(os.environ.get("CHUNK_SIZE_CHARS", str(chunk_size or 1200)))
     ov = int(os.environ.get("CHUNK_OVERLAP", str(overlap or 200)))
+    return cs, ov
 
-    # удалить старые чанки
-    Chunk.query.filter_by(article_id=article.id).delete()
-    db.session.flush()
 
-    text = html_to_text(article.content or "")
-    parts = chunk_text(text, cs, ov)
-    for i, part in enumerate(parts):
-        db.session.add(Chunk(article_id=article.id, idx=i, text=part, tokens=len(part.split())))
+def _content_sha(content: str, cs: int, ov: int) -> str:
+    # хеш контента вместе с параметрами разбивки: их смена тоже требует пересборки
+    return hashlib.blake2b(f"{cs}:{ov}:{content or ''}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _write_chunks(article_id: int, text: str, sha: str, parts: List[str],
+                  expected_content: str | None = None) -> bool:
+    """
+    Заменяем чанки статьи и кешированный плейнтекст (без commit).
+    expected_content — контент, из которого посчитаны чанки: если статью успели
+    отредактировать, ничего не пишем и возвращаем False.
+    """
+    upd = (
+        Article.__table__.update()
+        .where(Article.id == article_id)
+        .values(content_text=text, content_sha=sha)
+    )
+    if expected_content is not None:
+        upd = upd.where(func.coalesce(Article.__table__.c.content, "") == expected_content)
+    # UPDATE первым: он же берёт блокировку на запись до DELETE/INSERT чанков
+    if db.session.execute(upd).rowcount == 0:
+        return False
+    db.session.execute(Chunk.__table__.delete().where(Chunk.article_id == article_id))
+    # новые чанки — одним executemany, минуя unit of work
+    rows = [
+        {"article_id": article_id, "idx": i, "text": part, "tokens": len(part.split())}
+        for i, part in enumerate(parts)
+    ]
+    if rows:
+        db.session.execute(Chunk.__table__.insert(), rows)
+    return True
+
+
+def rebuild_article_chunks(article: Article, chunk_size: int | None = None, overlap: int | None = None):
+    """
+    Пересобираем чанки одной статьи (вызывается после создания/редактирования/отката).
+    Если контент и параметры разбивки не менялись с прошлой пересборки — ничего не делаем.
+    """
+    cs, ov = _chunk_params(chunk_size, overlap)
+    sha = _content_sha(article.content, cs, ov)
+    if article.content_sha == sha and article.content_text is not None:
+        return
+
+    text, parts = compute_chunks(article.content, cs, ov)
+    # пересборки идут в фоне; если статью уже сохранили заново, чанки устаревшего
+    # контента не пишем — их запишет задача, запущенная тем сохранением
+    written = _write_chunks(article.id, text, sha, parts, expected_content=article.content or "")
     db.session.commit()
+    if not written:
+        return
+    # объект в сессии тоже обновим, чтобы не перечитывать его из БД
+    set_committed_value(article, "content_text", text)
+    set_committed_value(article, "content_sha", sha)
 
 
-def rebuild_all_chunks():
-    for a in Article.query.filter_by(is_deleted=False).all():
-        rebuild_article_chunks(a)
+_REBUILD_COMMIT_EVERY = 50  # статей на одну транзакцию при полной пересборке
+
+
+def _compute_chunks_star(args):
+    return compute_chunks(*args)
+
+
+def rebuild_all_chunks(workers: int | None = None):
+    """
+    Полная пересборка. Разбор HTML — CPU-bound и независим по статьям,
+    поэтому гоним его в пуле процессов, а в БД пишем из текущего потока.
+    Commit — после каждых _REBUILD_COMMIT_EVERY статей: блокировку SQLite на запись
+    держим недолго, и сохранения статей во время пересборки не ждут её окончания.
+    """
+    cs, ov = _chunk_params()
+    rows = (
+        db.session.query(Article.id, Article.content)
+        .filter(Article.is_deleted == False)  # noqa: E712
+        .order_by(Article.id)
+        .yield_per(500)
+    )
+    articles = [(a_id, content or "") for a_id, content in rows]
+    if not articles:
+        return
+
+    workers = workers or int(os.environ.get("RAG_REBUILD_WORKERS", "0")) or os.cpu_count() or 1
+    workers = min(workers, len(articles))
+    jobs = [(content, cs, ov) for _, content in articles]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_compute_chunks_star, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+    else:
+        results = [_compute_chunks_star(j) for j in jobs]
+
+    # пока шёл разбор, статьи могли отредактировать (и пересобрать их чанки отдельной
+    # задачей) — пишем только те, чей контент совпадает со снимком
+    for i, ((a_id, content), (text, parts)) in enumerate(zip(articles, results), 1):
+        _write_chunks(a_id, text, _content_sha(content, cs, ov), parts, expected_content=content)
+        if i % _REBUILD_COMMIT_EVERY == 0:
+            db.session.commit()
+    db.session.commit()
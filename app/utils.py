@@ -3,10 +3,29 @@ from functools import wraps
 from flask import session, redirect, url_for, flash, request
 from typing import Dict, Tuple
 
+# Парсер для BeautifulSoup: lxml (C) заметно быстрее встроенного html.parser.
+# Годится для проходов "только чтение": при сериализации lxml дописывает <html>/<body>.
+try:
+    import lxml  # noqa: F401
+    BS_PARSER = "lxml"
+except ImportError:
+    BS_PARSER = "html.parser"
+
+# path -> ((st_mtime_ns, st_size), users): файл перечитывается только после изменения
+_users_cache: Dict[str, Tuple[Tuple[int, int], Dict[str, dict]]] = {}
+
 def parse_users_file(path: str) -> Dict[str, dict]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        _users_cache.pop(path, None)
+        return {}
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _users_cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
     users = {}
-    if not os.path.exists(path):
-        return users
     with open(path, "r", encoding="utf-8") as f:
         for line in f:
             s = line.strip()
@@ -22,6 +41,7 @@ def parse_users_file(path: str) -> Dict[str, dict]:
                 "last_name": last_name,
                 "is_admin": login == "Admin"
             }
+    _users_cache[path] = (key, users)
     return users
 
 def current_user():